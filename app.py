@@ -1,10 +1,20 @@
 from flask import Flask
-from flask_passwordless_auth import PasswordlessAuth
+from flask_compress import Compress
+from flask_migrate import Migrate
+from flask_passwordless_auth import PasswordlessAuth, db
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+_TRUTHY = frozenset({'true', 'on', '1', 'yes'})
+
+
+def _env_bool(name, default='false'):
+    """Parse a boolean environment variable once, at import time."""
+    return os.getenv(name, default).lower() in _TRUTHY
+
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
@@ -13,15 +23,25 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # Email configuration
 app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
 app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 587))
-app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', 'true').lower() in ['true', 'on', '1']
+app.config['MAIL_USE_TLS'] = _env_bool('MAIL_USE_TLS', 'true')
 app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
 
 # Set this to True for development, False for production
-app.config['MAIL_SUPPRESS_SEND'] = os.getenv('MAIL_SUPPRESS_SEND', 'true').lower() in ['true', 'on', '1']
+app.config['MAIL_SUPPRESS_SEND'] = _env_bool('MAIL_SUPPRESS_SEND', 'true')
+
+# Broker for the background email worker; leave unset to send emails eagerly
+# in-process (no worker needed)
+app.config['CELERY_BROKER_URL'] = os.getenv('CELERY_BROKER_URL')
+
+Compress(app)
 
+# One shared set of extensions: PasswordlessAuth binds the module-level db to
+# this app, and Flask-Migrate runs the migrations/ scripts against that same
+# instance.
 passwordless = PasswordlessAuth(app)
+migrate = Migrate(app, db)
 
 @app.route('/')
 @passwordless.login_required
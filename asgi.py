@@ -0,0 +1,12 @@
+# asgi.py
+#
+# ASGI entry point: wraps the WSGI app so it can run under an async server
+# (hypercorn/uvicorn), e.g.:
+#
+#     hypercorn --bind 0.0.0.0:8080 --workers 4 asgi:asgi_app
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app
+
+asgi_app = WsgiToAsgi(app)
@@ -0,0 +1,11 @@
+# celery_worker.py
+#
+# Celery worker entry point. Importing the application module runs
+# PasswordlessAuth.init_app, which points the tasks at the Flask app and
+# applies the broker/queue configuration, so start the worker with:
+#
+#     celery -A celery_worker worker -Q mail
+
+import app as _app  # noqa: F401  initializes the Flask app the tasks use
+
+from flask_passwordless_auth import celery  # noqa: F401
@@ -1,59 +1,286 @@
 # flask_passwordless_auth.py
 
-from flask import current_app, Flask, request, render_template_string, redirect, url_for, flash
+from celery import Celery
+from flask import current_app, Flask, request, render_template, redirect, url_for, flash, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user
-from flask_mail import Mail, Message
-from itsdangerous import URLSafeTimedSerializer
+from flask_mail import Mail
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from jinja2 import BaseLoader, ChoiceLoader, TemplateNotFound
+from sqlalchemy import bindparam, select
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
-import random
-import string
+from datetime import datetime
+import hashlib
+import hmac
+import queue
+import secrets
+import smtplib
 import logging
+import threading
+import time
+from email.message import EmailMessage
 from functools import wraps
 
+# How long a login code stays valid, in seconds.
+CODE_MAX_AGE = 600
+
+# Constant parts of the login email, built once at import.
+LOGIN_SUBJECT = 'Your Login Code'
+LOGIN_BODY = 'Your 6-digit login code is: {code}'
+
+# Logging configuration is left to the application; as a library we only
+# attach to our own named logger.
+logger = logging.getLogger(__name__)
+
+celery = Celery(__name__)
+
+# Flask app the Celery worker runs tasks against; set by PasswordlessAuth.init_app.
+_flask_app = None
+
+# Single shared SQLAlchemy instance; bound to the app in init_app. Keeping the
+# models at module scope means their mappers (and SQLAlchemy's per-statement
+# compilation cache) are set up once, not per init_app call.
+db = SQLAlchemy()
+
+
+class User(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(100), unique=True, nullable=False)
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Token(db.Model):
+    """Login codes from deployments predating the signed-session flow.
+
+    Nothing reads or writes this table anymore; it is kept only so existing
+    databases keep migrating cleanly.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    token_hash = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Built once so SQLAlchemy's compiled-statement cache is hit on every
+# execution instead of recompiling a fresh Query each request.
+_USER_BY_EMAIL = select(User).where(User.email == bindparam('email'))
+
+# Per-process cache for the flask_login user loader, which otherwise costs one
+# SELECT on every authenticated request. The TTL is kept short so deactivating
+# a user still takes effect within seconds.
+USER_CACHE_TTL = 5
+USER_CACHE_MAXSIZE = 10_000
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+
+def _cache_user(user):
+    """Store a transient copy of a user, safe to use after its session closes."""
+    copy = User(email=user.email, is_active=user.is_active, created_at=user.created_at)
+    copy.id = user.id
+    with _user_cache_lock:
+        if len(_user_cache) >= USER_CACHE_MAXSIZE:
+            _user_cache.clear()
+        _user_cache[user.id] = (copy, time.monotonic() + USER_CACHE_TTL)
+    return copy
+
+
+def _invalidate_cached_user(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+
+# Warm SMTP connections reused across sends, so the TCP + STARTTLS + AUTH
+# handshake is paid once per connection instead of once per email.
+_smtp_pool = queue.Queue()
+
+
+def _smtp_connect(config):
+    smtp = smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'])
+    smtp.ehlo()
+    if config.get('MAIL_USE_TLS'):
+        smtp.starttls()
+        smtp.ehlo()
+    if config.get('MAIL_USERNAME'):
+        smtp.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+    return smtp
+
+
+@celery.task(bind=True, max_retries=5, default_retry_delay=10)
+def send_login_code(self, email, subject, body):
+    """Send a login code email from a Celery worker.
+
+    Sends over a pooled smtplib connection using the app's MAIL_*
+    configuration. Transient SMTP failures are retried.
+    """
+    config = _flask_app.config
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = config['MAIL_DEFAULT_SENDER']
+    msg['To'] = email
+    msg.set_content(body)
+    try:
+        try:
+            smtp = _smtp_pool.get_nowait()
+        except queue.Empty:
+            smtp = _smtp_connect(config)
+        try:
+            smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # The pooled connection went stale; reconnect once and resend.
+            smtp = _smtp_connect(config)
+            smtp.send_message(msg)
+        _smtp_pool.put_nowait(smtp)
+    except (smtplib.SMTPException, OSError) as e:
+        # Eager mode runs on the request thread; fail fast there instead of
+        # blocking the response on retries.
+        if self.request.is_eager:
+            raise
+        raise self.retry(exc=e)
+
+
+class StringTemplateLoader(BaseLoader):
+    """Serve templates from an in-memory dict of constant strings.
+
+    The uptodate callable returns True so Jinja compiles each template once
+    and reuses the compiled object instead of reparsing it per render.
+    """
+
+    def __init__(self, templates):
+        self.templates = templates
+
+    def get_source(self, environment, template):
+        try:
+            source = self.templates[template]
+        except KeyError:
+            raise TemplateNotFound(template)
+        return source, None, lambda: True
+
+
 class PasswordlessAuth:
-    def __init__(self, app=None):
+    def __init__(self, app=None, mail=None, login_manager=None):
         self.app = app
+        # Explicitly passed extensions take precedence; otherwise init_app
+        # reuses whatever the application already registered.
+        self.mail = mail
+        self.login_manager = login_manager
+        self._serializer = None
+        self._serializer_lock = threading.Lock()
+        self._code_hmac_key = None
         if app is not None:
             self.init_app(app)
 
+    @property
+    def serializer(self):
+        """Signer for pending-login payloads, built once on first use.
+
+        Lazily constructed under a lock so concurrent first requests share a
+        single instance (itsdangerous caches the derived key inside it). The
+        salt scopes the derived key to this extension's login payloads.
+        """
+        if self._serializer is None:
+            with self._serializer_lock:
+                if self._serializer is None:
+                    self._serializer = URLSafeTimedSerializer(
+                        current_app.config['SECRET_KEY'], salt='passwordless-login')
+        return self._serializer
+
+    def _code_digest(self, code):
+        """Keyed digest of a login code; the key never leaves the server.
+
+        The session cookie is signed but readable by the client, so a plain
+        sha256 of a 6-digit code (10^6 values) could be brute-forced offline
+        from the cookie alone. HMAC with a SECRET_KEY-derived key keeps the
+        digest uncomputable without the server secret.
+        """
+        if self._code_hmac_key is None:
+            secret = current_app.config['SECRET_KEY']
+            self._code_hmac_key = hashlib.sha256(
+                b'passwordless-login-code:' + secret.encode()).digest()
+        return hmac.new(self._code_hmac_key, code.encode(), hashlib.sha256).hexdigest()
+
     def init_app(self, app):
-        self.db = SQLAlchemy(app)
-        self.login_manager = LoginManager(app)
+        # Bind the shared module-level db to this app (extension factory
+        # pattern); reuse other extensions the application already registered
+        # so there is only one Mail sender and login manager per app. The
+        # models are bound to this module's db, so a different SQLAlchemy
+        # instance on the same app cannot work and is rejected up front.
+        registered_db = app.extensions.get('sqlalchemy')
+        if registered_db is None:
+            db.init_app(app)
+        elif registered_db is not db:
+            raise RuntimeError(
+                'A different SQLAlchemy instance is already registered on this '
+                'app. The PasswordlessAuth models are bound to '
+                'flask_passwordless_auth.db; import and use that shared '
+                'instance instead of creating your own.'
+            )
+        self.db = db
+        if self.login_manager is None:
+            self.login_manager = getattr(app, 'login_manager', None) or LoginManager(app)
         self.login_manager.login_view = 'passwordless.login'
-        self.mail = Mail(app)
-        self.serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
-
-        # Set up logging
-        logging.basicConfig(level=logging.INFO)
-        self.logger = logging.getLogger(__name__)
-
-        # Register models
-        class User(UserMixin, self.db.Model):
-            id = self.db.Column(self.db.Integer, primary_key=True)
-            email = self.db.Column(self.db.String(100), unique=True, nullable=False)
-            is_active = self.db.Column(self.db.Boolean, default=True)
-            created_at = self.db.Column(self.db.DateTime, default=datetime.utcnow)
-
-        class Token(self.db.Model):
-            id = self.db.Column(self.db.Integer, primary_key=True)
-            user_id = self.db.Column(self.db.Integer, self.db.ForeignKey('user.id'), nullable=False)
-            token = self.db.Column(self.db.String(6), nullable=False)
-            created_at = self.db.Column(self.db.DateTime, default=datetime.utcnow)
+        if self.mail is None:
+            self.mail = app.extensions['mail'] if 'mail' in app.extensions else Mail(app)
+        # Read once at init time instead of on every login POST.
+        self.suppress_send = app.config.get('MAIL_SUPPRESS_SEND', False)
+
+        # Configure the Celery app used for background email delivery.
+        # Without a broker, tasks run eagerly so development setups keep working.
+        global _flask_app
+        _flask_app = app
+        broker_url = app.config.get('CELERY_BROKER_URL')
+        celery.conf.update(
+            broker_url=broker_url,
+            task_always_eager=broker_url is None,
+            # Surface eager failures to the caller; otherwise they are
+            # swallowed into the discarded EagerResult.
+            task_eager_propagates=True,
+            task_routes={'flask_passwordless_auth.send_login_code': {'queue': 'mail'}},
+        )
 
+        # Only configure logging when the application hasn't; without any
+        # handler the suppressed-send login codes would be silently dropped.
+        if not logging.getLogger().handlers:
+            logging.basicConfig(level=logging.INFO)
+        self.logger = logger
         self.User = User
         self.Token = Token
 
         @self.login_manager.user_loader
         def load_user(user_id):
-            return User.query.get(int(user_id))
+            uid = int(user_id)
+            with _user_cache_lock:
+                entry = _user_cache.get(uid)
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+            user = db.session.get(User, uid)
+            if user is None:
+                return None
+            return _cache_user(user)
+
+        # Register the login template under a name and pre-warm it so the
+        # compiled template is cached before the first request.
+        app.jinja_loader = ChoiceLoader([
+            app.jinja_loader,
+            StringTemplateLoader({'passwordless_login': self.login_template}),
+        ])
+        app.jinja_env.get_template('passwordless_login')
 
         # Register routes
         app.add_url_rule('/login', 'passwordless.login', self.login, methods=['GET', 'POST'])
         app.add_url_rule('/verify-code', 'passwordless.verify_code', self.verify_code, methods=['POST'])
         app.add_url_rule('/logout', 'passwordless.logout', self.logout)
 
+        # These endpoints take no arguments, so their URLs are constant;
+        # computing them once spares a url_for (map bind + rule match) per
+        # template render.
+        with app.test_request_context():
+            app.jinja_env.globals['LOGIN_URL'] = url_for('passwordless.login')
+            app.jinja_env.globals['VERIFY_URL'] = url_for('passwordless.verify_code')
+            app.jinja_env.globals['LOGOUT_URL'] = url_for('passwordless.logout')
+
     def login_required(self, f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
@@ -68,50 +295,69 @@ class PasswordlessAuth:
         
         if request.method == 'POST':
             email = request.form['email']
-            user = self.User.query.filter_by(email=email).first()
-            if not user:
-                user = self.User(email=email)
-                self.db.session.add(user)
-                self.db.session.commit()
-            
-            # Generate 6-digit token
-            digit_token = ''.join(random.choices(string.digits, k=6))
-            new_token = self.Token(user_id=user.id, token=digit_token)
-            self.db.session.add(new_token)
-            self.db.session.commit()
-            
-            # Create email message
-            msg = Message('Your Login Code',
-                          recipients=[email])
-            msg.body = f'Your 6-digit login code is: {digit_token}'
-            
+            user = db.session.execute(_USER_BY_EMAIL, {'email': email}).scalar_one_or_none()
+            new_user = user is None
+            if new_user:
+                user = User(email=email)
+                db.session.add(user)
+                # flush assigns user.id without ending the transaction, so the
+                # payload below is built before the single commit.
+                db.session.flush()
+
+            # Generate 6-digit token; only a keyed hash of it is kept, in the
+            # signed session cookie, so no Token row is written per login
+            # attempt and the cookie alone is useless to its holder.
+            digit_token = f"{secrets.randbelow(1_000_000):06d}"
+            code_hash = self._code_digest(digit_token)
+            session['pending_login'] = self.serializer.dumps({'uid': user.id, 'h': code_hash})
+            if new_user:
+                db.session.commit()
+
+            body = LOGIN_BODY.format(code=digit_token)
+
             # Send email (or log it if in development mode)
-            if current_app.config['MAIL_SUPPRESS_SEND']:
+            if self.suppress_send:
                 self.logger.info(f"Email to: {email}")
-                self.logger.info(f"Subject: {msg.subject}")
-                self.logger.info(f"Body: {msg.body}")
+                self.logger.info(f"Subject: {LOGIN_SUBJECT}")
+                self.logger.info(f"Body: {body}")
             else:
-                self.mail.send(msg)
+                # Enqueue instead of sending on the request thread; the SMTP
+                # handshake no longer blocks the response.
+                send_login_code.delay(email, LOGIN_SUBJECT, body)
             
-            return render_template_string(self.login_template, email_sent=True, email=email)
+            return render_template('passwordless_login', email_sent=True, email=email)
         
-        return render_template_string(self.login_template, email_sent=False)
+        return render_template('passwordless_login', email_sent=False)
 
     def verify_code(self):
         email = request.form['email']
-        entered_code = ''.join([request.form.get(f'code{i}', '') for i in range(6)])
-        user = self.User.query.filter_by(email=email).first()
+        entered_code = request.form.get('code', '')
+        # A code that is not exactly 6 ASCII digits can never match; reject it
+        # before spending a query on it.
+        if len(entered_code) != 6 or not (entered_code.isascii() and entered_code.isdigit()):
+            flash('Invalid code. Please try again.', 'error')
+            return redirect(url_for('passwordless.login'))
+        user = db.session.execute(_USER_BY_EMAIL, {'email': email}).scalar_one_or_none()
         if user:
-            token = self.Token.query.filter_by(user_id=user.id).order_by(self.Token.created_at.desc()).first()
-            if token and token.token == entered_code:
-                if datetime.utcnow() - token.created_at <= timedelta(minutes=10):
-                    login_user(user)
-                    self.db.session.delete(token)
-                    self.db.session.commit()
-                    next_page = request.args.get('next')
-                    return redirect(next_page or url_for('dashboard'))
-                else:
+            signed = session.get('pending_login')
+            payload = None
+            if signed:
+                try:
+                    payload = self.serializer.loads(signed, max_age=CODE_MAX_AGE)
+                except SignatureExpired:
+                    session.pop('pending_login', None)
                     flash('The code has expired. Please request a new one.', 'error')
+                    return redirect(url_for('passwordless.login'))
+                except BadSignature:
+                    payload = None
+            entered_hash = self._code_digest(entered_code)
+            if payload and payload['uid'] == user.id and hmac.compare_digest(payload['h'], entered_hash):
+                # Consume the code only on success, like the old row delete,
+                # so a typo in the auto-submitting boxes stays recoverable.
+                session.pop('pending_login', None)
+                login_user(user)
+                next_page = request.args.get('next')
+                return redirect(next_page or url_for('dashboard'))
             else:
                 flash('Invalid code. Please try again.', 'error')
         else:
@@ -119,6 +365,8 @@ class PasswordlessAuth:
         return redirect(url_for('passwordless.login'))
 
     def logout(self):
+        if current_user.is_authenticated:
+            _invalidate_cached_user(current_user.id)
         logout_user()
         flash('You have been logged out.', 'info')
         return redirect(url_for('passwordless.login'))
@@ -131,30 +379,7 @@ class PasswordlessAuth:
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Login - Passwordless Auth</title>
     <link href="https://cdnjs.cloudflare.com/ajax/libs/tailwindcss/2.2.19/tailwind.min.css" rel="stylesheet">
-    <style>
-        @keyframes fadeIn {
-            from { opacity: 0; transform: translateY(-10px); }
-            to { opacity: 1; transform: translateY(0); }
-        }
-        .fade-in {
-            animation: fadeIn 0.5s ease-out;
-        }
-        .code-input {
-            width: 2.5rem;
-            height: 3rem;
-            font-size: 1.5rem;
-            border: 2px solid #e5e7eb;
-            border-radius: 0.5rem;
-            text-align: center;
-            margin-right: 0.5rem;
-            transition: all 0.3s ease;
-        }
-        .code-input:focus {
-            border-color: #000;
-            box-shadow: 0 0 0 3px rgba(0, 0, 0, 0.1);
-            outline: none;
-        }
-    </style>
+    <style>@keyframes fadeIn{from{opacity:0;transform:translateY(-10px)}to{opacity:1;transform:translateY(0)}}.fade-in{animation:fadeIn .5s ease-out}.code-input{width:2.5rem;height:3rem;font-size:1.5rem;border:2px solid #e5e7eb;border-radius:.5rem;text-align:center;margin-right:.5rem;transition:all .3s ease}.code-input:focus{border-color:#000;box-shadow:0 0 0 3px rgba(0,0,0,.1);outline:none}</style>
 </head>
 <body class="bg-white min-h-screen flex items-center justify-center">
     <div class="container max-w-md w-full p-8 fade-in">        
@@ -170,16 +395,17 @@ class PasswordlessAuth:
         
         {% if email_sent %}
             <p class="text-gray-600 mb-6 text-center">Enter the 6-digit code sent to your email:</p>
-            <form id="verify-form" method="POST" action="{{ url_for('passwordless.verify_code') }}" class="space-y-6">
+            <form id="verify-form" method="POST" action="{{ VERIFY_URL }}" class="space-y-6">
                 <input type="hidden" name="email" value="{{ email }}">
+                <input type="hidden" name="code" id="code-value">
                 <div class="flex justify-center space-x-2">
                     {% for i in range(6) %}
-                    <input type="text" name="code{{ i }}" class="code-input" maxlength="1" required pattern="[0-9]" inputmode="numeric" data-index="{{ i }}">
+                    <input type="text" class="code-input" maxlength="1" required pattern="[0-9]" inputmode="numeric" data-index="{{ i }}">
                     {% endfor %}
                 </div>
             </form>
             <p class="mt-4 text-center text-sm text-gray-600">
-                Didn't receive the code? <a href="{{ url_for('passwordless.login') }}" class="text-black hover:underline">Try again</a>
+                Didn't receive the code? <a href="{{ LOGIN_URL }}" class="text-black hover:underline">Try again</a>
             </p>
         {% else %}
             <form id="email-form" method="POST" class="space-y-6">
@@ -193,55 +419,10 @@ class PasswordlessAuth:
         {% endif %}
     </div>
 
-    <script>
-        function handlePaste(e) {
-            e.preventDefault();
-            const paste = (e.clipboardData || window.clipboardData).getData('text');
-            const digits = paste.replace(/\D/g, '').slice(0, 6);
-            const inputs = document.querySelectorAll('.code-input');
-            digits.split('').forEach((digit, index) => {
-                if (inputs[index]) {
-                    inputs[index].value = digit;
-                    if (index === 5) {
-                        document.getElementById('verify-form').submit();
-                    }
-                }
-            });
-        }
-
-        function handleInput(e) {
-            const input = e.target;
-            if (input.value.length === 1) {
-                const nextInput = input.nextElementSibling;
-                if (nextInput && nextInput.tagName === 'INPUT') {
-                    nextInput.focus();
-                }
-                if (input.getAttribute('data-index') === '5') {
-                    document.getElementById('verify-form').submit();
-                }
-            }
-        }
-
-        document.addEventListener('DOMContentLoaded', function() {
-            const codeInputs = document.querySelectorAll('.code-input');
-            codeInputs.forEach(input => {
-                input.addEventListener('paste', handlePaste);
-                input.addEventListener('input', handleInput);
-            });
-
-            // Auto focus email field on load
-            const emailInput = document.getElementById('email');
-            if (emailInput) {
-                emailInput.focus();
-            }
-
-            // Auto focus first code input when it appears
-            const firstCodeInput = document.querySelector('.code-input');
-            if (firstCodeInput) {
-                firstCodeInput.focus();
-            }
-        });
-    </script>
+    <script>function submitIfComplete(){const inputs=document.querySelectorAll('.code-input');const code=Array.from(inputs).map(input=>input.value).join('');if(code.length===6){document.getElementById('code-value').value=code;document.getElementById('verify-form').submit()}}
+function handlePaste(e){e.preventDefault();const paste=(e.clipboardData||window.clipboardData).getData('text');const digits=paste.replace(/\D/g,'').slice(0,6);const inputs=document.querySelectorAll('.code-input');digits.split('').forEach((digit,index)=>{if(inputs[index]){inputs[index].value=digit}});submitIfComplete()}
+function handleInput(e){const input=e.target;if(input.value.length===1){const nextInput=input.nextElementSibling;if(nextInput&&nextInput.tagName==='INPUT'){nextInput.focus()}if(input.getAttribute('data-index')==='5'){submitIfComplete()}}}
+document.addEventListener('DOMContentLoaded',function(){document.querySelectorAll('.code-input').forEach(input=>{input.addEventListener('paste',handlePaste);input.addEventListener('input',handleInput)});const emailInput=document.getElementById('email');if(emailInput){emailInput.focus()}const firstCodeInput=document.querySelector('.code-input');if(firstCodeInput){firstCodeInput.focus()}});</script>
 </body>
 </html>
     """
\ No newline at end of file
@@ -0,0 +1,34 @@
+"""drop the unused token index and purge expired legacy rows
+
+Revision ID: a9e47c1528d6
+Revises: f3c81d07a6b2
+Create Date: 2026-08-26 15:27:54.103627
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from datetime import datetime, timedelta
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9e47c1528d6'
+down_revision = 'f3c81d07a6b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # No query has touched the token table since verification moved to the
+    # signed session payload; drop the index and clear out the expired rows
+    # left over from deployments that stored codes in the DB.
+    op.drop_index('ix_token_user_created', table_name='token')
+    cutoff = datetime.utcnow() - timedelta(minutes=10)
+    op.get_bind().execute(
+        sa.text('DELETE FROM token WHERE created_at < :cutoff'),
+        {'cutoff': cutoff})
+
+
+def downgrade():
+    op.create_index('ix_token_user_created', 'token',
+                    ['user_id', sa.text('created_at DESC')])
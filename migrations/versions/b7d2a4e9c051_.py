@@ -0,0 +1,36 @@
+"""store login code hashes instead of plaintext codes
+
+Revision ID: b7d2a4e9c051
+Revises: ca96b1ff41d3
+Create Date: 2026-08-26 09:12:45.318264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2a4e9c051'
+down_revision = 'ca96b1ff41d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # batch mode so the rename+retype works on SQLite (via table copy) as
+    # well as on databases with native ALTER COLUMN support.
+    with op.batch_alter_table('token') as batch_op:
+        batch_op.alter_column('token',
+                              new_column_name='token_hash',
+                              existing_type=sa.String(length=6),
+                              type_=sa.String(length=64),
+                              existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('token') as batch_op:
+        batch_op.alter_column('token_hash',
+                              new_column_name='token',
+                              existing_type=sa.String(length=64),
+                              type_=sa.String(length=6),
+                              existing_nullable=False)
@@ -0,0 +1,25 @@
+"""composite index on token (user_id, created_at DESC)
+
+Revision ID: f3c81d07a6b2
+Revises: b7d2a4e9c051
+Create Date: 2026-08-26 09:41:03.574918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c81d07a6b2'
+down_revision = 'b7d2a4e9c051'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_token_user_created', 'token',
+                    ['user_id', sa.text('created_at DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_token_user_created', table_name='token')